@@ -13,6 +13,12 @@ if __name__ == "__main__":
     # Use torch.float16 if GPU does not support torch.bfloat16
     # ome graphics cards, such as v100, 2080ti, do not support torch.bfloat16
     weight_dtype = torch.bfloat16
+    # Compile the transformer with torch.compile when the whole pipeline fits in GPU memory,
+    # the first generation of each resolution is slower because of compilation
+    enable_compile = False
+    # Quantize the transformer weights to int8 with torchao, only used when ui_mode = "modelscope",
+    # lora can not be used together with it
+    quantize_transformer = False
 
     # Server ip
     server_name = "0.0.0.0"
@@ -23,11 +29,11 @@ if __name__ == "__main__":
     savedir_sample = "samples"
 
     if ui_mode == "modelscope":
-        demo, controller = ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
+        demo, controller = ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype, enable_compile, quantize_transformer)
     elif ui_mode == "eas":
         demo, controller = ui_eas(model_name, savedir_sample)
     else:
-        demo, controller = ui(low_gpu_memory_mode, weight_dtype)
+        demo, controller = ui(low_gpu_memory_mode, weight_dtype, enable_compile)
 
     # launch gradio
     app, _, _ = demo.queue(status_update_rate=1).launch(
@@ -37,9 +43,10 @@ if __name__ == "__main__":
     )
     
     # launch api
-    infer_forward_api(None, app, controller)
-    update_diffusion_transformer_api(None, app, controller)
-    update_edition_api(None, app, controller)
+    if controller is not None:
+        infer_forward_api(None, app, controller)
+        update_diffusion_transformer_api(None, app, controller)
+        update_edition_api(None, app, controller)
     
     # not close the python
     while True:
@@ -413,7 +413,7 @@ class CogVideoX_Fun_Pipeline_Inpaint(DiffusionPipeline):
             for i in range(0, video.shape[0], bs):
                 video_bs = video[i : i + bs]
                 video_bs = self.vae.encode(video_bs)[0]
-                video_bs = video_bs.sample()
+                video_bs = video_bs.sample(generator=generator[i] if isinstance(generator, list) else generator)
                 new_video.append(video_bs)
             video = torch.cat(new_video, dim = 0)
             video = video * self.vae.config.scaling_factor
@@ -1,11 +1,16 @@
 """Modified from https://github.com/guoyww/AnimateDiff/blob/main/app.py
 """
+import atexit
 import base64
 import gc
 import json
 import os
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from glob import glob
 
 import cv2
@@ -14,6 +19,7 @@ import numpy as np
 import pkg_resources
 import requests
 import torch
+import torchvision
 from diffusers import (AutoencoderKL, AutoencoderKLCogVideoX,
                        CogVideoXDDIMScheduler, DDIMScheduler,
                        DPMSolverMultistepScheduler,
@@ -23,10 +29,21 @@ from diffusers.utils.import_utils import is_xformers_available
 from omegaconf import OmegaConf
 from PIL import Image
 from safetensors import safe_open
+from safetensors.torch import load_file
 from transformers import (CLIPImageProcessor, CLIPVisionModelWithProjection,
                           T5EncoderModel, T5Tokenizer)
 
-from cogvideox.data.bucket_sampler import ASPECT_RATIO_512, get_closest_ratio
+try:
+    from diffusers.hooks import apply_group_offloading
+except ImportError:
+    apply_group_offloading = None
+try:
+    from torchao.quantization import int8_weight_only, quantize_
+except ImportError:
+    quantize_ = None
+
+from cogvideox.data.bucket_sampler import (ASPECT_RATIO_512, get_closest_ratio,
+                                           get_image_size_without_loading)
 from ..models.autoencoder_magvit import AutoencoderKLCogVideoX
 from cogvideox.models.transformer3d import CogVideoXTransformer3DModel
 from cogvideox.pipeline.pipeline_cogvideox import CogVideoX_Fun_Pipeline
@@ -48,6 +65,108 @@ scheduler_dict = {
 
 gradio_version = pkg_resources.get_distribution("gradio").version
 gradio_version_is_above_4 = True if int(gradio_version.split('.')[0]) >= 4 else False
+# Since gradio 4, updates are returned as components instead of Component.update dicts
+image_update   = gr.Image if gradio_version_is_above_4 else gr.Image.update
+video_update   = gr.Video if gradio_version_is_above_4 else gr.Video.update
+textbox_update = gr.Textbox if gradio_version_is_above_4 else gr.Textbox.update
+
+# Release the CUDA cache after a failed generation, useful when the GPU is shared with other processes.
+# Set ENABLE_CACHE_CLEANING=1 to turn it on.
+ENABLE_CACHE_CLEANING = os.environ.get("ENABLE_CACHE_CLEANING", "0").lower() in ("1", "true")
+
+@lru_cache(maxsize=None)
+def get_aspect_ratio_sample_size(base_resolution):
+    return {key : [x / 512 * base_resolution for x in ASPECT_RATIO_512[key]] for key in ASPECT_RATIO_512.keys()}
+
+def scan_dir(directory, suffix=None):
+    # Sorted sub-folders of directory, or files ending with suffix when it is given.
+    # Hidden entries are skipped and a missing directory gives an empty list, like glob.
+    if not os.path.isdir(directory):
+        return []
+    with os.scandir(directory) as entries:
+        if suffix is None:
+            return sorted(entry.path + os.sep for entry in entries if not entry.name.startswith(".") and entry.is_dir())
+        return sorted(entry.name for entry in entries if not entry.name.startswith(".") and entry.name.endswith(suffix))
+
+def get_tensor_memory(tensor):
+    # Tensor subclasses, like torchao quantized weights, report the original dtype,
+    # so sum the inner tensors that really hold the data.
+    if hasattr(tensor, "__tensor_flatten__"):
+        inner_names, _ = tensor.__tensor_flatten__()
+        return sum(get_tensor_memory(getattr(tensor, name)) for name in inner_names)
+    return tensor.numel() * tensor.element_size()
+
+def get_pipeline_memory(pipeline):
+    # Bytes taken by the weights of every torch module of the pipeline
+    memory = 0
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            memory += sum(get_tensor_memory(p) for p in component.parameters())
+            memory += sum(get_tensor_memory(b) for b in component.buffers())
+    return memory
+
+def get_free_gpu_memory():
+    free_memory, _ = torch.cuda.mem_get_info()
+    # Blocks cached by PyTorch's allocator are free for this process as well
+    return free_memory + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+@lru_cache(maxsize=64)
+def get_image_size_by_mtime(image_path, mtime_ns):
+    return get_image_size_without_loading(image_path)
+
+def get_image_size(image_path):
+    # The modification time is part of the key, so a file replaced at the same path is measured again
+    return get_image_size_by_mtime(image_path, os.stat(image_path).st_mtime_ns)
+
+def get_video_size(video_path):
+    # Read from the container metadata, so no frame is decoded
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+
+sampler_choices = tuple(scheduler_dict)
+source_method_choices = ("Text to Video (文本到视频)", "Image to Video (图片到视频)", "Video to Video (视频到视频)")
+eas_default_prompt = "A young woman with beautiful and clear eyes and blonde hair standing and white dress in a forest wearing a crown. She seems to be lost in thought, and the camera focuses on her face. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic."
+eas_default_negative_prompt = "The video is not of a high quality, it has a low resolution. Watermark present in each frame. Strange motion trajectory.  "
+
+# Updates returned by the ui_eas callbacks, one fixed set per choice. Gradio 3 pops "value"
+# from the update dicts it receives, so the callbacks return copies.
+eas_generation_method_updates = {
+    "Video Generation": gr.update(visible=True, minimum=5, maximum=49, value=49, interactive=True),
+    "Image Generation": gr.update(minimum=1, maximum=1, value=1, interactive=False),
+}
+eas_source_method_updates = {
+    source_method_choices[0]: (gr.update(visible=False), gr.update(visible=False), gr.update(value=None), gr.update(value=None), gr.update(value=None)),
+    source_method_choices[1]: (gr.update(visible=True), gr.update(visible=False), gr.update(), gr.update(), gr.update(value=None)),
+    source_method_choices[2]: (gr.update(visible=False), gr.update(visible=True), gr.update(value=None), gr.update(value=None), gr.update()),
+}
+eas_resize_method_updates = {
+    "Generate by": (gr.update(visible=True), gr.update(visible=True), gr.update(visible=False)),
+    "Resize according to Reference": (gr.update(visible=False), gr.update(visible=False), gr.update(visible=True)),
+}
+
+rng = random.Random()
+
+def random_seed_update():
+    return textbox_update(value=rng.randrange(1, 100_000_001))
+
+def copy_updates(updates):
+    return [dict(update) for update in updates]
+
+template_gallery_path = ("asset/1.png", "asset/2.png", "asset/3.png", "asset/4.png", "asset/5.png")
+template_prompts = {
+    "asset/1.png": "The dog is looking at camera and smiling. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
+    "asset/2.png": "a sailboat sailing in rough seas with a dramatic sunset. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
+    "asset/3.png": "a beautiful woman with long hair and a dress blowing in the wind. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
+    "asset/4.png": "a man in an astronaut suit playing a guitar. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
+    "asset/5.png": "fireworks display over night city. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
+}
+
+def select_template(evt: gr.SelectData):
+    path = template_gallery_path[evt.index]
+    return path, template_prompts[path]
 
 css = """
 .toolbutton {
@@ -59,7 +178,7 @@ css = """
 """
 
 class CogVideoX_I2VController:
-    def __init__(self, low_gpu_memory_mode, weight_dtype):
+    def __init__(self, low_gpu_memory_mode, weight_dtype, enable_compile=False):
         # config dirs
         self.basedir                    = os.getcwd()
         self.config_dir                 = os.path.join(self.basedir, "config")
@@ -69,6 +188,8 @@ class CogVideoX_I2VController:
         self.savedir                    = os.path.join(self.basedir, "samples", datetime.now().strftime("Gradio-%Y-%m-%dT%H-%M-%S"))
         self.savedir_sample             = os.path.join(self.savedir, "sample")
         os.makedirs(self.savedir, exist_ok=True)
+        self.logs_file                  = open(os.path.join(self.savedir, "logs.json"), "a", buffering=1)
+        atexit.register(self.logs_file.close)
 
         self.diffusion_transformer_list = []
         self.motion_module_list      = []
@@ -88,34 +209,54 @@ class CogVideoX_I2VController:
         self.base_model_path       = "none"
         self.lora_model_path       = "none"
         self.low_gpu_memory_mode   = low_gpu_memory_mode
+        self.enable_compile        = enable_compile
+        # schedulers built for the current pipeline, keyed by sampler name
+        self.scheduler_cache       = {}
+        self.current_sampler       = None
+        # (lora path, alpha) currently merged into the pipeline weights
+        self.merged_lora           = None
+        # text embeddings of the latest (prompt, negative prompt) pairs, least recently used first
+        self.prompt_embeds_cache   = OrderedDict()
         
-        self.weight_dtype = weight_dtype
+        self.weight_dtype  = weight_dtype
+        # where the weights live between requests, used when merging lora
+        self.weight_device = "cpu"
 
     def refresh_diffusion_transformer(self):
-        self.diffusion_transformer_list = sorted(glob(os.path.join(self.diffusion_transformer_dir, "*/")))
+        self.diffusion_transformer_list = scan_dir(self.diffusion_transformer_dir)
 
     def refresh_motion_module(self):
-        motion_module_list = sorted(glob(os.path.join(self.motion_module_dir, "*.safetensors")))
-        self.motion_module_list = [os.path.basename(p) for p in motion_module_list]
+        self.motion_module_list = scan_dir(self.motion_module_dir, ".safetensors")
 
     def refresh_personalized_model(self):
-        personalized_model_list = sorted(glob(os.path.join(self.personalized_model_dir, "*.safetensors")))
-        self.personalized_model_list = [os.path.basename(p) for p in personalized_model_list]
+        self.personalized_model_list = scan_dir(self.personalized_model_dir, ".safetensors")
 
     def update_diffusion_transformer(self, diffusion_transformer_dropdown):
         print("Update diffusion transformer")
         if diffusion_transformer_dropdown == "none":
             return gr.update()
+        # Release the previous pipeline before loading the new one. The compiled forward keeps a
+        # reference cycle to its transformer, so collect it and the compile caches explicitly,
+        # otherwise the free memory measured below still counts the old weights.
+        self.pipeline = self.transformer = self.vae = None
+        self.prompt_embeds_cache.clear()
+        torch._dynamo.reset()
+        gc.collect()
+        torch.cuda.empty_cache()
+
         self.vae = AutoencoderKLCogVideoX.from_pretrained(
             diffusion_transformer_dropdown, 
             subfolder="vae", 
-        ).to(self.weight_dtype)
+            torch_dtype=self.weight_dtype,
+            low_cpu_mem_usage=True,
+        )
 
         # Get Transformer
         self.transformer = CogVideoXTransformer3DModel.from_pretrained_2d(
             diffusion_transformer_dropdown, 
             subfolder="transformer", 
-        ).to(self.weight_dtype)
+            torch_dtype=self.weight_dtype,
+        )
         
         # Get pipeline
         if self.transformer.config.in_channels != self.vae.config.latent_channels:
@@ -134,11 +275,29 @@ class CogVideoX_I2VController:
                 scheduler=scheduler_dict["Euler"].from_pretrained(diffusion_transformer_dropdown, subfolder="scheduler"),
                 torch_dtype=self.weight_dtype
             )
+        self.scheduler_cache = {}
+        self.current_sampler = None
+        self.merged_lora     = None
+        self.prompt_embeds_cache.clear()
 
         if self.low_gpu_memory_mode:
             self.pipeline.enable_sequential_cpu_offload()
+            self.weight_device = "cpu"
+        elif get_pipeline_memory(self.pipeline) < 0.7 * get_free_gpu_memory():
+            # Keep the whole pipeline on the GPU when the weights leave enough room for
+            # activations, so that no modules are moved between CPU and GPU per request.
+            self.pipeline.to("cuda")
+            self.weight_device = "cuda"
         else:
             self.pipeline.enable_model_cpu_offload()
+            self.weight_device = "cpu"
+
+        if self.enable_compile:
+            # CUDA graphs need the weights to stay at the same address, which offload breaks
+            if self.weight_device == "cuda":
+                self.transformer.forward = torch.compile(self.transformer.forward, mode="reduce-overhead", fullgraph=False, dynamic=False)
+            else:
+                print("Skip compiling the transformer, because the pipeline is offloaded to cpu")
         print("Update diffusion transformer done")
         return gr.update()
 
@@ -151,12 +310,20 @@ class CogVideoX_I2VController:
             gr.Info(f"Please select a pretrained model path.")
             return gr.update(value=None)
         else:
+            # The base weights replace the merged ones, so the lora is merged again by the next generate.
+            self.unmerge_current_lora()
             base_model_dropdown = os.path.join(self.personalized_model_dir, base_model_dropdown)
-            base_model_state_dict = {}
+            # Copy tensor by tensor into the existing parameters, so that only a few tensors
+            # of the checkpoint are held in memory at a time. Reads are spread over a thread
+            # pool to overlap the disk I/O of different tensors.
+            transformer_state_dict = self.transformer.state_dict()
             with safe_open(base_model_dropdown, framework="pt", device="cpu") as f:
-                for key in f.keys():
-                    base_model_state_dict[key] = f.get_tensor(key)
-            self.transformer.load_state_dict(base_model_state_dict, strict=False)
+                def load_tensor(key):
+                    transformer_state_dict[key].copy_(f.get_tensor(key))
+
+                keys = [key for key in f.keys() if key in transformer_state_dict]
+                with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+                    list(executor.map(load_tensor, keys))
             print("Update base done")
             return gr.update()
 
@@ -165,10 +332,36 @@ class CogVideoX_I2VController:
         if lora_model_dropdown == "none":
             self.lora_model_path = "none"
             return gr.update()
+        if self.low_gpu_memory_mode:
+            raise gr.Error(f"Lora can not be merged while low_gpu_memory_mode is enabled, please select none.")
         lora_model_dropdown = os.path.join(self.personalized_model_dir, lora_model_dropdown)
         self.lora_model_path = lora_model_dropdown
         return gr.update()
 
+    def unmerge_current_lora(self):
+        if self.merged_lora is not None:
+            lora_model_path, lora_alpha = self.merged_lora
+            self.pipeline = unmerge_lora(self.pipeline, lora_model_path, multiplier=lora_alpha, device=self.weight_device)
+            self.merged_lora = None
+            # the lora may change the text encoder as well
+            self.prompt_embeds_cache.clear()
+
+    def encode_prompt(self, prompt, negative_prompt):
+        key = (prompt, negative_prompt)
+        if key in self.prompt_embeds_cache:
+            self.prompt_embeds_cache.move_to_end(key)
+        else:
+            with torch.no_grad():
+                self.prompt_embeds_cache[key] = self.pipeline.encode_prompt(
+                    prompt, 
+                    negative_prompt, 
+                    do_classifier_free_guidance=negative_prompt is not None, 
+                    device=self.pipeline._execution_device,
+                )
+            if len(self.prompt_embeds_cache) > 8:
+                self.prompt_embeds_cache.popitem(last=False)
+        return self.prompt_embeds_cache[key]
+
     def generate(
         self,
         diffusion_transformer_dropdown,
@@ -195,9 +388,10 @@ class CogVideoX_I2VController:
         seed_textbox,
         is_api = False,
     ):
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+        if self.low_gpu_memory_mode:
+            gc.collect()
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
 
         if self.transformer is None:
             raise gr.Error(f"Please select a pretrained model path.")
@@ -216,12 +410,12 @@ class CogVideoX_I2VController:
                 else:
                     raise gr.Error(f"Please upload an image when using \"Resize according to Reference\".")
 
-            aspect_ratio_sample_size    = {key : [x / 512 * base_resolution for x in ASPECT_RATIO_512[key]] for key in ASPECT_RATIO_512.keys()}
+            aspect_ratio_sample_size    = get_aspect_ratio_sample_size(base_resolution)
             
             if validation_video is not None:
-                original_width, original_height = Image.fromarray(cv2.VideoCapture(validation_video).read()[1]).size
+                original_width, original_height = get_video_size(validation_video)
             else:
-                original_width, original_height = start_image[0].size if type(start_image) is list else Image.open(start_image).size
+                original_width, original_height = start_image[0].size if type(start_image) is list else get_image_size(start_image)
             closest_size, closest_ratio = get_closest_ratio(original_height, original_width, ratios=aspect_ratio_sample_size)
             height_slider, width_slider = [int(x / 16) * 16 for x in closest_size]
 
@@ -245,22 +439,33 @@ class CogVideoX_I2VController:
 
         is_image = True if generation_method == "Image Generation" else False
 
-        self.pipeline.scheduler = scheduler_dict[sampler_dropdown].from_config(self.pipeline.scheduler.config)
-        if self.lora_model_path != "none":
-            # lora part
-            self.pipeline = merge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
+        if sampler_dropdown != self.current_sampler:
+            if sampler_dropdown not in self.scheduler_cache:
+                self.scheduler_cache[sampler_dropdown] = scheduler_dict[sampler_dropdown].from_config(self.pipeline.scheduler.config)
+            self.pipeline.scheduler = self.scheduler_cache[sampler_dropdown]
+            self.current_sampler = sampler_dropdown
+        # lora part, kept merged across requests while the lora and its alpha do not change
+        if self.merged_lora != (self.lora_model_path, lora_alpha_slider):
+            self.unmerge_current_lora()
+            if self.lora_model_path != "none":
+                self.pipeline = merge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider, device=self.weight_device)
+                self.merged_lora = (self.lora_model_path, lora_alpha_slider)
+                self.prompt_embeds_cache.clear()
 
-        if int(seed_textbox) != -1 and seed_textbox != "": torch.manual_seed(int(seed_textbox))
-        else: seed_textbox = np.random.randint(0, 1e10)
+        if int(seed_textbox) == -1 or seed_textbox == "": seed_textbox = np.random.randint(0, 1e10)
+        # one generator per request, api requests may run concurrently
         generator = torch.Generator(device="cuda").manual_seed(int(seed_textbox))
         
         try:
+            # Without guidance the pipelines skip the unconditional branch, so the negative prompt is not encoded at all
+            prompt_embeds, negative_prompt_embeds = self.encode_prompt(prompt_textbox, negative_prompt_textbox if cfg_scale_slider > 1.0 else None)
             if self.transformer.config.in_channels != self.vae.config.latent_channels:
                 if generation_method == "Long Video Generation":
                     if validation_video is not None:
                         raise gr.Error(f"Video to Video is not Support Long Video Generation now.")
                     init_frames = 0
                     last_frames = init_frames + partial_video_length
+                    mix_ratio = (torch.arange(overlap_video_length, dtype=torch.float32) / overlap_video_length).view(1, 1, -1, 1, 1)
                     while init_frames < length_slider:
                         if last_frames >= length_slider:
                             _partial_video_length = length_slider - init_frames
@@ -278,8 +483,8 @@ class CogVideoX_I2VController:
 
                         with torch.no_grad():
                             sample = self.pipeline(
-                                prompt_textbox, 
-                                negative_prompt     = negative_prompt_textbox,
+                                prompt_embeds          = prompt_embeds,
+                                negative_prompt_embeds = negative_prompt_embeds,
                                 num_inference_steps = sample_step_slider,
                                 guidance_scale      = cfg_scale_slider,
                                 width               = width_slider,
@@ -291,14 +496,12 @@ class CogVideoX_I2VController:
                                 mask_video   = input_video_mask,
                                 strength     = 1,
                             ).videos
+                        input_video = input_video_mask = None
                         
                         if init_frames != 0:
-                            mix_ratio = torch.from_numpy(
-                                np.array([float(_index) / float(overlap_video_length) for _index in range(overlap_video_length)], np.float32)
-                            ).unsqueeze(0).unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-                            
-                            new_sample[:, :, -overlap_video_length:] = new_sample[:, :, -overlap_video_length:] * (1 - mix_ratio) + \
-                                sample[:, :, :overlap_video_length] * mix_ratio
+                            new_sample[:, :, -overlap_video_length:] = torch.lerp(
+                                new_sample[:, :, -overlap_video_length:], sample[:, :, :overlap_video_length], mix_ratio
+                            )
                             new_sample = torch.cat([new_sample, sample[:, :, overlap_video_length:]], dim = 2)
 
                             sample = new_sample
@@ -308,14 +511,12 @@ class CogVideoX_I2VController:
                         if last_frames >= length_slider:
                             break
 
-                        start_image = [
-                            Image.fromarray(
-                                (sample[0, :, _index].transpose(0, 1).transpose(1, 2) * 255).numpy().astype(np.uint8)
-                            ) for _index in range(-overlap_video_length, 0)
-                        ]
+                        # the overlap frames condition the next chunk directly, without a PIL round trip
+                        start_image = sample[0, :, -overlap_video_length:].permute(1, 0, 2, 3).clone()
 
                         init_frames = init_frames + _partial_video_length - overlap_video_length
                         last_frames = init_frames + _partial_video_length
+                    start_image = None
                 else:
                     if validation_video is not None:
                         input_video, input_video_mask, clip_image = get_video_to_video_latent(validation_video, length_slider if not is_image else 1, sample_size=(height_slider, width_slider))
@@ -325,8 +526,8 @@ class CogVideoX_I2VController:
                         strength = 1
 
                     sample = self.pipeline(
-                        prompt_textbox,
-                        negative_prompt     = negative_prompt_textbox,
+                        prompt_embeds          = prompt_embeds,
+                        negative_prompt_embeds = negative_prompt_embeds,
                         num_inference_steps = sample_step_slider,
                         guidance_scale      = cfg_scale_slider,
                         width               = width_slider,
@@ -338,10 +539,11 @@ class CogVideoX_I2VController:
                         mask_video   = input_video_mask,
                         strength     = strength,
                     ).videos
+                    input_video = input_video_mask = None
             else:
                 sample = self.pipeline(
-                    prompt_textbox,
-                    negative_prompt     = negative_prompt_textbox,
+                    prompt_embeds          = prompt_embeds,
+                    negative_prompt_embeds = negative_prompt_embeds,
                     num_inference_steps = sample_step_slider,
                     guidance_scale      = cfg_scale_slider,
                     width               = width_slider,
@@ -350,24 +552,17 @@ class CogVideoX_I2VController:
                     generator           = generator
                 ).videos
         except Exception as e:
-            gc.collect()
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-            if self.lora_model_path != "none":
-                self.pipeline = unmerge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
+            # Only give cached blocks back to the driver after an OOM or when the allocator is
+            # close to the limit, otherwise the next request can simply reuse them.
+            is_oom = "out of memory" in str(e).lower()
+            if self.low_gpu_memory_mode or is_oom or torch.cuda.memory_reserved() > 0.8 * torch.cuda.get_device_properties(0).total_memory:
+                gc.collect()
+                torch.cuda.empty_cache()
             if is_api:
                 return "", f"Error. error information is {str(e)}"
             else:
                 return gr.update(), gr.update(), f"Error. error information is {str(e)}"
 
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-
-        # lora part
-        if self.lora_model_path != "none":
-            self.pipeline = unmerge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
-
         sample_config = {
             "prompt": prompt_textbox,
             "n_prompt": negative_prompt_textbox,
@@ -380,49 +575,37 @@ class CogVideoX_I2VController:
             "seed_textbox": seed_textbox
         }
         json_str = json.dumps(sample_config, indent=4)
-        with open(os.path.join(self.savedir, "logs.json"), "a") as f:
-            f.write(json_str)
-            f.write("\n\n")
+        self.logs_file.write(json_str + "\n\n")
             
         if not os.path.exists(self.savedir_sample):
             os.makedirs(self.savedir_sample, exist_ok=True)
-        index = len([path for path in os.listdir(self.savedir_sample)]) + 1
+        with os.scandir(self.savedir_sample) as entries:
+            index = sum(1 for _ in entries) + 1
         prefix = str(index).zfill(3)
 
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
         if is_image or length_slider == 1:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".png")
+            save_sample_path = os.path.join(self.savedir_sample, prefix + ".png")
 
-            image = sample[0, :, 0]
-            image = image.transpose(0, 1).transpose(1, 2)
-            image = (image * 255).numpy().astype(np.uint8)
+            image = sample[0, :, 0].permute(1, 2, 0).mul(255).clamp_(0, 255).to(torch.uint8).cpu().numpy()
             image = Image.fromarray(image)
             image.save(save_sample_path)
 
             if is_api:
                 return save_sample_path, "Success"
             else:
-                if gradio_version_is_above_4:
-                    return gr.Image(value=save_sample_path, visible=True), gr.Video(value=None, visible=False), "Success"
-                else:
-                    return gr.Image.update(value=save_sample_path, visible=True), gr.Video.update(value=None, visible=False), "Success"
+                return image_update(value=save_sample_path, visible=True), video_update(value=None, visible=False), "Success"
         else:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".mp4")
-            save_videos_grid(sample, save_sample_path, fps=8)
+            save_sample_path = os.path.join(self.savedir_sample, prefix + ".mp4")
+            save_videos_grid(sample.mul(255).clamp_(0, 255).to(torch.uint8), save_sample_path, fps=8)
 
             if is_api:
                 return save_sample_path, "Success"
             else:
-                if gradio_version_is_above_4:
-                    return gr.Image(visible=False, value=None), gr.Video(value=save_sample_path, visible=True), "Success"
-                else:
-                    return gr.Image.update(visible=False, value=None), gr.Video.update(value=save_sample_path, visible=True), "Success"
+                return image_update(visible=False, value=None), video_update(value=save_sample_path, visible=True), "Success"
 
 
-def ui(low_gpu_memory_mode, weight_dtype):
-    controller = CogVideoX_I2VController(low_gpu_memory_mode, weight_dtype)
+def ui(low_gpu_memory_mode, weight_dtype, enable_compile=False):
+    controller = CogVideoX_I2VController(low_gpu_memory_mode, weight_dtype, enable_compile)
 
     with gr.Blocks(css=css) as demo:
         gr.Markdown(
@@ -498,7 +681,7 @@ def ui(low_gpu_memory_mode, weight_dtype):
             with gr.Row():
                 with gr.Column():
                     with gr.Row():
-                        sampler_dropdown   = gr.Dropdown(label="Sampling method (采样器种类)", choices=list(scheduler_dict.keys()), value=list(scheduler_dict.keys())[0])
+                        sampler_dropdown   = gr.Dropdown(label="Sampling method (采样器种类)", choices=sampler_choices, value=sampler_choices[0])
                         sample_step_slider = gr.Slider(label="Sampling steps (生成步数)", value=50, minimum=10, maximum=100, step=1)
                         
                     resize_method = gr.Radio(
@@ -522,8 +705,8 @@ def ui(low_gpu_memory_mode, weight_dtype):
                             partial_video_length = gr.Slider(label="Partial video generation length (每个部分的视频生成帧数)", value=25, minimum=5,   maximum=49,  step=4, visible=False)
                     
                     source_method = gr.Radio(
-                        ["Text to Video (文本到视频)", "Image to Video (图片到视频)", "Video to Video (视频到视频)"],
-                        value="Text to Video (文本到视频)",
+                        source_method_choices,
+                        value=source_method_choices[0],
                         show_label=False,
                     )
                     with gr.Column(visible = False) as image_to_video_col:
@@ -532,19 +715,8 @@ def ui(low_gpu_memory_mode, weight_dtype):
                             elem_id="i2v_start", sources="upload", type="filepath", 
                         )
                         
-                        template_gallery_path = ["asset/1.png", "asset/2.png", "asset/3.png", "asset/4.png", "asset/5.png"]
-                        def select_template(evt: gr.SelectData):
-                            text = {
-                                "asset/1.png": "The dog is looking at camera and smiling. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/2.png": "a sailboat sailing in rough seas with a dramatic sunset. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/3.png": "a beautiful woman with long hair and a dress blowing in the wind. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/4.png": "a man in an astronaut suit playing a guitar. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/5.png": "fireworks display over night city. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                            }[template_gallery_path[evt.index]]
-                            return template_gallery_path[evt.index], text
-
                         template_gallery = gr.Gallery(
-                            template_gallery_path,
+                            list(template_gallery_path),
                             columns=5, rows=1,
                             height=140,
                             allow_preview=False,
@@ -569,7 +741,7 @@ def ui(low_gpu_memory_mode, weight_dtype):
                         seed_textbox = gr.Textbox(label="Seed (随机种子)", value=43)
                         seed_button  = gr.Button(value="\U0001F3B2", elem_classes="toolbutton")
                         seed_button.click(
-                            fn=lambda: gr.Textbox(value=random.randint(1, 1e8)) if gradio_version_is_above_4 else gr.Textbox.update(value=random.randint(1, 1e8)), 
+                            fn=random_seed_update, 
                             inputs=[], 
                             outputs=[seed_textbox]
                         )
@@ -648,7 +820,7 @@ def ui(low_gpu_memory_mode, weight_dtype):
 
 
 class CogVideoX_I2VController_Modelscope:
-    def __init__(self, model_name, savedir_sample, low_gpu_memory_mode, weight_dtype):
+    def __init__(self, model_name, savedir_sample, low_gpu_memory_mode, weight_dtype, enable_compile=False, quantize_transformer=False):
         # Basic dir
         self.basedir                    = os.getcwd()
         self.personalized_model_dir     = os.path.join(self.basedir, "models", "Personalized_Model")
@@ -656,20 +828,44 @@ class CogVideoX_I2VController_Modelscope:
         self.savedir_sample             = savedir_sample
         self.refresh_personalized_model()
         os.makedirs(self.savedir_sample, exist_ok=True)
+        # Samples are numbered from a counter, so concurrent requests never get the same index
+        with os.scandir(self.savedir_sample) as entries:
+            self.sample_index = sum(1 for _ in entries)
+        self.sample_index_lock = threading.Lock()
 
         # model path
-        self.weight_dtype = weight_dtype
+        self.model_name          = model_name
+        self.weight_dtype        = weight_dtype
+        self.low_gpu_memory_mode = low_gpu_memory_mode
+        # schedulers built for the pipeline, keyed by sampler name
+        self.scheduler_cache = {}
+        self.current_sampler = None
+        # (lora path, alpha) currently merged into the pipeline weights, and the weights of the selected lora
+        self.merged_lora     = None
+        self.lora_state_dict = None
+        self.generate_lock   = threading.Lock()
+        # reseeded by every request instead of creating a new cuda generator
+        self.generator       = torch.Generator(device="cuda")
         
         self.vae = AutoencoderKLCogVideoX.from_pretrained(
             model_name, 
             subfolder="vae", 
-        ).to(self.weight_dtype)
+            torch_dtype=self.weight_dtype,
+            low_cpu_mem_usage=True,
+        )
 
         # Get Transformer
         self.transformer = CogVideoXTransformer3DModel.from_pretrained_2d(
             model_name, 
             subfolder="transformer", 
-        ).to(self.weight_dtype)
+            torch_dtype=self.weight_dtype,
+        )
+        # Int8 weight-only quantization halves the weight memory read by every transformer step
+        self.quantize_transformer = quantize_transformer and self.weight_dtype in (torch.bfloat16, torch.float16)
+        if self.quantize_transformer:
+            if quantize_ is None:
+                raise ImportError("Quantizing the transformer requires torchao, please install it with `pip install torchao`.")
+            quantize_(self.transformer, int8_weight_only())
         
         # Get pipeline
         if self.transformer.config.in_channels != self.vae.config.latent_channels:
@@ -689,10 +885,48 @@ class CogVideoX_I2VController_Modelscope:
                 torch_dtype=self.weight_dtype
             )
 
+        # Decode in tiles and one sample at a time, so the peak memory of long videos stays bounded
+        try:
+            self.vae.enable_tiling()
+            self.vae.enable_slicing()
+        except AttributeError:
+            pass
+
+        self.group_offload = False
         if low_gpu_memory_mode:
             self.pipeline.enable_sequential_cpu_offload()
+        elif get_pipeline_memory(self.pipeline) < 0.7 * get_free_gpu_memory():
+            self.pipeline.to("cuda")
+        elif apply_group_offloading is not None and not self.quantize_transformer:
+            # The transformer is offloaded block by block, and the next block is prefetched
+            # on a side stream while the current one runs. The text encoder only runs once
+            # per request, so it is offloaded layer by layer and only the vae stays on the GPU.
+            apply_group_offloading(
+                self.transformer, 
+                onload_device=torch.device("cuda"), 
+                offload_device=torch.device("cpu"), 
+                offload_type="block_level", 
+                num_blocks_per_group=1, 
+                use_stream=True,
+            )
+            apply_group_offloading(
+                self.pipeline.text_encoder, 
+                onload_device=torch.device("cuda"), 
+                offload_device=torch.device("cpu"), 
+                offload_type="leaf_level", 
+                use_stream=True,
+            )
+            self.vae.to("cuda")
+            # see disable_group_offload, lora needs another placement
+            self.group_offload = True
         else:
             self.pipeline.enable_model_cpu_offload()
+        if enable_compile:
+            # CUDA graphs need the weights to stay at the same address, which offload breaks
+            if next(self.transformer.parameters()).is_cuda:
+                self.transformer.forward = torch.compile(self.transformer.forward, mode="reduce-overhead", fullgraph=False, dynamic=False)
+            else:
+                print("Skip compiling the transformer, because the pipeline is offloaded to cpu")
         print("Update diffusion transformer done")
 
 
@@ -703,13 +937,53 @@ class CogVideoX_I2VController_Modelscope:
 
     def update_lora_model(self, lora_model_dropdown):
         print("Update lora model")
-        if lora_model_dropdown == "none":
-            self.lora_model_path = "none"
+        if lora_model_dropdown != "none":
+            lora_model_dropdown = os.path.join(self.personalized_model_dir, lora_model_dropdown)
+        if lora_model_dropdown == self.lora_model_path:
             return gr.update()
-        lora_model_dropdown = os.path.join(self.personalized_model_dir, lora_model_dropdown)
+        if lora_model_dropdown != "none" and self.quantize_transformer:
+            raise gr.Error(f"Lora can not be merged into a quantized transformer, please select none.")
+        if lora_model_dropdown != "none" and self.low_gpu_memory_mode:
+            raise gr.Error(f"Lora can not be merged while low_gpu_memory_mode is enabled, please select none.")
+        if lora_model_dropdown != "none" and self.group_offload:
+            self.disable_group_offload()
+        self.unmerge_current_lora()
         self.lora_model_path = lora_model_dropdown
+        if lora_model_dropdown == "none":
+            self.lora_state_dict = None
+        else:
+            # Read the lora once, in pinned memory so that merging into gpu layers copies it asynchronously.
+            self.lora_state_dict = load_file(lora_model_dropdown)
+            if torch.cuda.is_available():
+                self.lora_state_dict = {key: value.pin_memory() for key, value in self.lora_state_dict.items()}
         return gr.update()
 
+    def unmerge_current_lora(self):
+        if self.merged_lora is not None:
+            lora_model_path, lora_alpha = self.merged_lora
+            self.pipeline = unmerge_lora(self.pipeline, lora_model_path, multiplier=lora_alpha, state_dict=self.lora_state_dict)
+            self.merged_lora = None
+
+    def disable_group_offload(self):
+        # Group offloading onloads the weights from its own pinned copy, so lora merged into the
+        # parameters would never reach the GPU. Reload the hooked models and fall back to model
+        # cpu offload, which moves the parameters themselves.
+        print("Lora selected, switch from group offloading to model cpu offload")
+        self.transformer = CogVideoXTransformer3DModel.from_pretrained_2d(
+            self.model_name, 
+            subfolder="transformer", 
+            torch_dtype=self.weight_dtype,
+        )
+        text_encoder = T5EncoderModel.from_pretrained(
+            self.model_name, 
+            subfolder="text_encoder", 
+            torch_dtype=self.weight_dtype,
+        )
+        self.pipeline.register_modules(transformer=self.transformer, text_encoder=text_encoder)
+        self.group_offload = False
+        gc.collect()
+        self.pipeline.enable_model_cpu_offload()
+
     
     def generate(
         self,
@@ -737,27 +1011,19 @@ class CogVideoX_I2VController_Modelscope:
         seed_textbox,
         is_api = False,
     ):    
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-
         if self.transformer is None:
             raise gr.Error(f"Please select a pretrained model path.")
 
-        if self.lora_model_path != lora_model_dropdown:
-            print("Update lora model")
-            self.update_lora_model(lora_model_dropdown)
-
         if resize_method == "Resize according to Reference":
             if start_image is None and validation_video is None:
                 raise gr.Error(f"Please upload an image when using \"Resize according to Reference\".")
         
-            aspect_ratio_sample_size = {key : [x / 512 * base_resolution for x in ASPECT_RATIO_512[key]] for key in ASPECT_RATIO_512.keys()}
+            aspect_ratio_sample_size = get_aspect_ratio_sample_size(base_resolution)
             
             if validation_video is not None:
-                original_width, original_height = Image.fromarray(cv2.VideoCapture(validation_video).read()[1]).size
+                original_width, original_height = get_video_size(validation_video)
             else:
-                original_width, original_height = start_image[0].size if type(start_image) is list else Image.open(start_image).size
+                original_width, original_height = start_image[0].size if type(start_image) is list else get_image_size(start_image)
             closest_size, closest_ratio = get_closest_ratio(original_height, original_width, ratios=aspect_ratio_sample_size)
             height_slider, width_slider = [int(x / 16) * 16 for x in closest_size]
 
@@ -769,105 +1035,104 @@ class CogVideoX_I2VController_Modelscope:
 
         is_image = True if generation_method == "Image Generation" else False
 
-        self.pipeline.scheduler = scheduler_dict[sampler_dropdown].from_config(self.pipeline.scheduler.config)
-        if self.lora_model_path != "none":
-            # lora part
-            self.pipeline = merge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
+        # The scheduler, lora weights and pipeline are shared by all requests, so only one
+        # request may change and use them at a time.
+        with self.generate_lock:
+            self.update_lora_model(lora_model_dropdown)
 
-        if int(seed_textbox) != -1 and seed_textbox != "": torch.manual_seed(int(seed_textbox))
-        else: seed_textbox = np.random.randint(0, 1e10)
-        generator = torch.Generator(device="cuda").manual_seed(int(seed_textbox))
+            if sampler_dropdown != self.current_sampler:
+                if sampler_dropdown not in self.scheduler_cache:
+                    self.scheduler_cache[sampler_dropdown] = scheduler_dict[sampler_dropdown].from_config(self.pipeline.scheduler.config)
+                self.pipeline.scheduler = self.scheduler_cache[sampler_dropdown]
+                self.current_sampler = sampler_dropdown
+            # lora part, kept merged across requests while the lora and its alpha do not change
+            if self.merged_lora != (self.lora_model_path, lora_alpha_slider):
+                self.unmerge_current_lora()
+                if self.lora_model_path != "none":
+                    self.pipeline = merge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider, state_dict=self.lora_state_dict)
+                    self.merged_lora = (self.lora_model_path, lora_alpha_slider)
+
+            seed = int(seed_textbox) if str(seed_textbox).strip() not in ("", "-1") else random.getrandbits(63)
+            # The global rng is seeded as well, for any draw that is not given the generator.
+            # Requests are serialized by generate_lock, so this can not race.
+            torch.manual_seed(seed)
+            generator = self.generator.manual_seed(seed)
         
-        try:
-            if self.transformer.config.in_channels != self.vae.config.latent_channels:
-                if validation_video is not None:
-                    input_video, input_video_mask, clip_image = get_video_to_video_latent(validation_video, length_slider if not is_image else 1, sample_size=(height_slider, width_slider))
-                    strength = denoise_strength
-                else:
-                    input_video, input_video_mask, clip_image = get_image_to_video_latent(start_image, end_image, length_slider if not is_image else 1, sample_size=(height_slider, width_slider))
-                    strength = 1
-
-                sample = self.pipeline(
-                    prompt_textbox,
-                    negative_prompt     = negative_prompt_textbox,
-                    num_inference_steps = sample_step_slider,
-                    guidance_scale      = cfg_scale_slider,
-                    width               = width_slider,
-                    height              = height_slider,
-                    num_frames          = length_slider if not is_image else 1,
-                    generator           = generator,
+            # Without guidance the pipelines skip the unconditional branch, so the negative prompt is not needed
+            negative_prompt = negative_prompt_textbox if cfg_scale_slider > 1.0 else None
+            try:
+                if self.transformer.config.in_channels != self.vae.config.latent_channels:
+                    if validation_video is not None:
+                        input_video, input_video_mask, clip_image = get_video_to_video_latent(validation_video, length_slider if not is_image else 1, sample_size=(height_slider, width_slider))
+                        strength = denoise_strength
+                    else:
+                        input_video, input_video_mask, clip_image = get_image_to_video_latent(start_image, end_image, length_slider if not is_image else 1, sample_size=(height_slider, width_slider))
+                        strength = 1
 
-                    video        = input_video,
-                    mask_video   = input_video_mask,
-                    strength     = strength,
-                ).videos
-            else:
-                sample = self.pipeline(
-                    prompt_textbox,
-                    negative_prompt     = negative_prompt_textbox,
-                    num_inference_steps = sample_step_slider,
-                    guidance_scale      = cfg_scale_slider,
-                    width               = width_slider,
-                    height              = height_slider,
-                    num_frames          = length_slider if not is_image else 1,
-                    generator           = generator
-                ).videos
-        except Exception as e:
-            gc.collect()
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-            if self.lora_model_path != "none":
-                self.pipeline = unmerge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
-            if is_api:
-                return "", f"Error. error information is {str(e)}"
-            else:
-                return gr.update(), gr.update(), f"Error. error information is {str(e)}"
+                    sample = self.pipeline(
+                        prompt_textbox,
+                        negative_prompt     = negative_prompt,
+                        num_inference_steps = sample_step_slider,
+                        guidance_scale      = cfg_scale_slider,
+                        width               = width_slider,
+                        height              = height_slider,
+                        num_frames          = length_slider if not is_image else 1,
+                        generator           = generator,
 
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-        
-        # lora part
-        if self.lora_model_path != "none":
-            self.pipeline = unmerge_lora(self.pipeline, self.lora_model_path, multiplier=lora_alpha_slider)
+                        video        = input_video,
+                        mask_video   = input_video_mask,
+                        strength     = strength,
+                    ).videos
+                else:
+                    sample = self.pipeline(
+                        prompt_textbox,
+                        negative_prompt     = negative_prompt,
+                        num_inference_steps = sample_step_slider,
+                        guidance_scale      = cfg_scale_slider,
+                        width               = width_slider,
+                        height              = height_slider,
+                        num_frames          = length_slider if not is_image else 1,
+                        generator           = generator
+                    ).videos
+            except Exception as e:
+                if ENABLE_CACHE_CLEANING:
+                    # make sure the cache of the device in use is released on multi-gpu machines
+                    torch.cuda.set_device(torch.cuda.current_device())
+                    torch.cuda.empty_cache()
+                if is_api:
+                    return "", f"Error. error information is {str(e)}"
+                else:
+                    return gr.update(), gr.update(), f"Error. error information is {str(e)}"
 
         if not os.path.exists(self.savedir_sample):
             os.makedirs(self.savedir_sample, exist_ok=True)
-        index = len([path for path in os.listdir(self.savedir_sample)]) + 1
+        with self.sample_index_lock:
+            self.sample_index += 1
+            index = self.sample_index
         prefix = str(index).zfill(3)
         
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
         if is_image or length_slider == 1:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".png")
+            save_sample_path = os.path.join(self.savedir_sample, prefix + ".png")
 
-            image = sample[0, :, 0]
-            image = image.transpose(0, 1).transpose(1, 2)
-            image = (image * 255).numpy().astype(np.uint8)
-            image = Image.fromarray(image)
-            image.save(save_sample_path)
+            # write_png takes the CHW uint8 tensor as is and releases the GIL while compressing
+            image = sample[0, :, 0].clamp(0, 1).mul_(255).round_().to(torch.uint8).contiguous()
+            torchvision.io.write_png(image, save_sample_path, compression_level=3)
             if is_api:
                 return save_sample_path, "Success"
             else:
-                if gradio_version_is_above_4:
-                    return gr.Image(value=save_sample_path, visible=True), gr.Video(value=None, visible=False), "Success"
-                else:
-                    return gr.Image.update(value=save_sample_path, visible=True), gr.Video.update(value=None, visible=False), "Success"
+                return image_update(value=save_sample_path, visible=True), video_update(value=None, visible=False), "Success"
         else:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".mp4")
-            save_videos_grid(sample, save_sample_path, fps=8)
+            save_sample_path = os.path.join(self.savedir_sample, prefix + ".mp4")
+            # sample is not used afterwards, so it is scaled in place
+            save_videos_grid(sample.clamp_(0, 1).mul_(255).round_().to(torch.uint8), save_sample_path, fps=8)
             if is_api:
                 return save_sample_path, "Success"
             else:
-                if gradio_version_is_above_4:
-                    return gr.Image(visible=False, value=None), gr.Video(value=save_sample_path, visible=True), "Success"
-                else:
-                    return gr.Image.update(visible=False, value=None), gr.Video.update(value=save_sample_path, visible=True), "Success"
+                return image_update(visible=False, value=None), video_update(value=save_sample_path, visible=True), "Success"
 
 
-def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype):
-    controller = CogVideoX_I2VController_Modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
+def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype, enable_compile=False, quantize_transformer=False):
+    controller = CogVideoX_I2VController_Modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype, enable_compile, quantize_transformer)
 
     with gr.Blocks(css=css) as demo:
         gr.Markdown(
@@ -929,7 +1194,7 @@ def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
             with gr.Row():
                 with gr.Column():
                     with gr.Row():
-                        sampler_dropdown   = gr.Dropdown(label="Sampling method (采样器种类)", choices=list(scheduler_dict.keys()), value=list(scheduler_dict.keys())[0])
+                        sampler_dropdown   = gr.Dropdown(label="Sampling method (采样器种类)", choices=sampler_choices, value=sampler_choices[0])
                         sample_step_slider = gr.Slider(label="Sampling steps (生成步数)", value=50, minimum=10, maximum=50, step=1, interactive=False)
                     
                     resize_method = gr.Radio(
@@ -953,27 +1218,16 @@ def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
                         partial_video_length = gr.Slider(label="Partial video generation length (每个部分的视频生成帧数)", value=25, minimum=5,   maximum=49,  step=4, visible=False)
                         
                     source_method = gr.Radio(
-                        ["Text to Video (文本到视频)", "Image to Video (图片到视频)", "Video to Video (视频到视频)"],
-                        value="Text to Video (文本到视频)",
+                        source_method_choices,
+                        value=source_method_choices[0],
                         show_label=False,
                     )
                     with gr.Column(visible = False) as image_to_video_col:
                         with gr.Row():
                             start_image = gr.Image(label="The image at the beginning of the video (图片到视频的开始图片)", show_label=True, elem_id="i2v_start", sources="upload", type="filepath")
                         
-                        template_gallery_path = ["asset/1.png", "asset/2.png", "asset/3.png", "asset/4.png", "asset/5.png"]
-                        def select_template(evt: gr.SelectData):
-                            text = {
-                                "asset/1.png": "The dog is looking at camera and smiling. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/2.png": "a sailboat sailing in rough seas with a dramatic sunset. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/3.png": "a beautiful woman with long hair and a dress blowing in the wind. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/4.png": "a man in an astronaut suit playing a guitar. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/5.png": "fireworks display over night city. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                            }[template_gallery_path[evt.index]]
-                            return template_gallery_path[evt.index], text
-
                         template_gallery = gr.Gallery(
-                            template_gallery_path,
+                            list(template_gallery_path),
                             columns=5, rows=1,
                             height=140,
                             allow_preview=False,
@@ -998,7 +1252,7 @@ def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
                         seed_textbox = gr.Textbox(label="Seed (随机种子)", value=43)
                         seed_button  = gr.Button(value="\U0001F3B2", elem_classes="toolbutton")
                         seed_button.click(
-                            fn=lambda: gr.Textbox(value=random.randint(1, 1e8)) if gradio_version_is_above_4 else gr.Textbox.update(value=random.randint(1, 1e8)), 
+                            fn=random_seed_update, 
                             inputs=[], 
                             outputs=[seed_textbox]
                         )
@@ -1074,6 +1328,18 @@ def ui_modelscope(model_name, savedir_sample, low_gpu_memory_mode, weight_dtype)
     return demo, controller
 
 
+def read_file_as_base64(path, chunk_size=3 * 1024 * 1024):
+    # chunk_size is a multiple of 3, so the encoded chunks join without padding in between
+    # and the whole file never has to be held as bytes next to its encoding.
+    encoded_chunks = []
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            encoded_chunks.append(base64.b64encode(chunk).decode('ascii'))
+    return "".join(encoded_chunks)
+
 def post_eas(
     diffusion_transformer_dropdown,
     base_model_dropdown, lora_model_dropdown, lora_alpha_slider,
@@ -1083,22 +1349,13 @@ def post_eas(
     start_image, end_image, validation_video, denoise_strength, seed_textbox,
 ):
     if start_image is not None:
-        with open(start_image, 'rb') as file:
-            file_content = file.read()
-            start_image_encoded_content = base64.b64encode(file_content)
-            start_image = start_image_encoded_content.decode('utf-8')
+        start_image = read_file_as_base64(start_image)
 
     if end_image is not None:
-        with open(end_image, 'rb') as file:
-            file_content = file.read()
-            end_image_encoded_content = base64.b64encode(file_content)
-            end_image = end_image_encoded_content.decode('utf-8')
+        end_image = read_file_as_base64(end_image)
 
     if validation_video is not None:
-        with open(validation_video, 'rb') as file:
-            file_content = file.read()
-            validation_video_encoded_content = base64.b64encode(file_content)
-            validation_video = validation_video_encoded_content.decode('utf-8')
+        validation_video = read_file_as_base64(validation_video)
 
     datas = {
         "base_model_path": base_model_dropdown,
@@ -1131,10 +1388,45 @@ def post_eas(
     return outputs
 
 
+def write_bytes_unbuffered(path, data):
+    # Small payloads go to the file descriptor directly, without setting up a buffered file object
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def write_base64_to_file(path, base64_encoding, write_buffer, chunk_size=4 * 65536):
+    # Decode chunk by chunk into the file, so the decoded payload never exists as a whole in memory.
+    # chunk_size is a multiple of 4, so every chunk is valid base64 on its own. The decoded chunks are
+    # gathered in write_buffer, a preallocated bytearray reused across calls, and written out whenever
+    # it is full, so the file itself needs no buffer of its own.
+    view = memoryview(write_buffer)
+    filled = 0
+    with open(path, "wb", buffering=0) as file:
+        for start in range(0, len(base64_encoding), chunk_size):
+            decoded_data = base64.b64decode(base64_encoding[start:start + chunk_size])
+            if filled + len(decoded_data) > len(view):
+                write_view(file, view[:filled])
+                filled = 0
+            view[filled:filled + len(decoded_data)] = decoded_data
+            filled += len(decoded_data)
+        write_view(file, view[:filled])
+
+def write_view(file, view):
+    # An unbuffered file may write only part of the data at once
+    while view:
+        view = view[file.write(view):]
+
 class CogVideoX_I2VController_EAS:
-    def __init__(self, edition, config_path, model_name, savedir_sample):
+    def __init__(self, model_name, savedir_sample):
         self.savedir_sample = savedir_sample
         os.makedirs(self.savedir_sample, exist_ok=True)
+        # reused by every video save, one save at a time
+        self.write_buffer   = bytearray(1 << 20)
+        self.write_lock     = threading.Lock()
 
     def generate(
         self,
@@ -1173,35 +1465,28 @@ class CogVideoX_I2VController_EAS:
         try:
             base64_encoding = outputs["base64_encoding"]
         except:
-            return gr.Image(visible=False, value=None), gr.Video(None, visible=True), outputs["message"]
-            
-        decoded_data = base64.b64decode(base64_encoding)
+            return image_update(visible=False, value=None), video_update(value=None, visible=True), outputs["message"]
 
-        if not os.path.exists(self.savedir_sample):
-            os.makedirs(self.savedir_sample, exist_ok=True)
         index = len([path for path in os.listdir(self.savedir_sample)]) + 1
         prefix = str(index).zfill(3)
         
-        if is_image or length_slider == 1:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".png")
-            with open(save_sample_path, "wb") as file:
-                file.write(decoded_data)
-            if gradio_version_is_above_4:
-                return gr.Image(value=save_sample_path, visible=True), gr.Video(value=None, visible=False), "Success"
-            else:
-                return gr.Image.update(value=save_sample_path, visible=True), gr.Video.update(value=None, visible=False), "Success"
+        is_image = is_image or length_slider == 1
+        save_sample_path = os.path.join(self.savedir_sample, prefix + (".png" if is_image else ".mp4"))
+        if is_image:
+            # a png is small, so it is decoded at once and written with a single system call
+            write_bytes_unbuffered(save_sample_path, base64.b64decode(base64_encoding))
         else:
-            save_sample_path = os.path.join(self.savedir_sample, prefix + f".mp4")
-            with open(save_sample_path, "wb") as file:
-                file.write(decoded_data)
-            if gradio_version_is_above_4:
-                return gr.Image(visible=False, value=None), gr.Video(value=save_sample_path, visible=True), "Success"
-            else:
-                return gr.Image.update(visible=False, value=None), gr.Video.update(value=save_sample_path, visible=True), "Success"
+            with self.write_lock:
+                write_base64_to_file(save_sample_path, base64_encoding, self.write_buffer)
+        if is_image:
+            return image_update(value=save_sample_path, visible=True), video_update(value=None, visible=False), "Success"
+        else:
+            return image_update(visible=False, value=None), video_update(value=save_sample_path, visible=True), "Success"
 
 
 def ui_eas(model_name, savedir_sample):
-    controller = CogVideoX_I2VController_EAS(model_name, savedir_sample)
+    # The controller is only created by the first generation, so the page is served right away
+    get_controller = lru_cache(maxsize=1)(lambda: CogVideoX_I2VController_EAS(model_name, savedir_sample))
 
     with gr.Blocks(css=css) as demo:
         gr.Markdown(
@@ -1257,13 +1542,13 @@ def ui_eas(model_name, savedir_sample):
                 """
             )
             
-            prompt_textbox = gr.Textbox(label="Prompt", lines=2, value="A young woman with beautiful and clear eyes and blonde hair standing and white dress in a forest wearing a crown. She seems to be lost in thought, and the camera focuses on her face. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.")
-            negative_prompt_textbox = gr.Textbox(label="Negative prompt", lines=2, value="The video is not of a high quality, it has a low resolution. Watermark present in each frame. Strange motion trajectory.  " )
+            prompt_textbox = gr.Textbox(label="Prompt", lines=2, value=eas_default_prompt)
+            negative_prompt_textbox = gr.Textbox(label="Negative prompt", lines=2, value=eas_default_negative_prompt)
                 
             with gr.Row():
                 with gr.Column():
                     with gr.Row():
-                        sampler_dropdown   = gr.Dropdown(label="Sampling method", choices=list(scheduler_dict.keys()), value=list(scheduler_dict.keys())[0])
+                        sampler_dropdown   = gr.Dropdown(label="Sampling method", choices=sampler_choices, value=sampler_choices[0])
                         sample_step_slider = gr.Slider(label="Sampling steps", value=50, minimum=10, maximum=50, step=1, interactive=False)
                     
                     resize_method = gr.Radio(
@@ -1285,26 +1570,15 @@ def ui_eas(model_name, savedir_sample):
                         length_slider = gr.Slider(label="Animation length (视频帧数)", value=49, minimum=5,   maximum=49,  step=4)
                     
                     source_method = gr.Radio(
-                        ["Text to Video (文本到视频)", "Image to Video (图片到视频)", "Video to Video (视频到视频)"],
-                        value="Text to Video (文本到视频)",
+                        source_method_choices,
+                        value=source_method_choices[0],
                         show_label=False,
                     )
                     with gr.Column(visible = False) as image_to_video_col:
                         start_image = gr.Image(label="The image at the beginning of the video", show_label=True, elem_id="i2v_start", sources="upload", type="filepath")
                         
-                        template_gallery_path = ["asset/1.png", "asset/2.png", "asset/3.png", "asset/4.png", "asset/5.png"]
-                        def select_template(evt: gr.SelectData):
-                            text = {
-                                "asset/1.png": "The dog is looking at camera and smiling. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/2.png": "a sailboat sailing in rough seas with a dramatic sunset. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/3.png": "a beautiful woman with long hair and a dress blowing in the wind. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/4.png": "a man in an astronaut suit playing a guitar. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                                "asset/5.png": "fireworks display over night city. The video is of high quality, and the view is very clear. High quality, masterpiece, best quality, highres, ultra-detailed, fantastic.", 
-                            }[template_gallery_path[evt.index]]
-                            return template_gallery_path[evt.index], text
-
                         template_gallery = gr.Gallery(
-                            template_gallery_path,
+                            list(template_gallery_path),
                             columns=5, rows=1,
                             height=140,
                             allow_preview=False,
@@ -1329,7 +1603,7 @@ def ui_eas(model_name, savedir_sample):
                         seed_textbox = gr.Textbox(label="Seed", value=43)
                         seed_button  = gr.Button(value="\U0001F3B2", elem_classes="toolbutton")
                         seed_button.click(
-                            fn=lambda: gr.Textbox(value=random.randint(1, 1e8)) if gradio_version_is_above_4 else gr.Textbox.update(value=random.randint(1, 1e8)), 
+                            fn=random_seed_update, 
                             inputs=[], 
                             outputs=[seed_textbox]
                         )
@@ -1346,36 +1620,25 @@ def ui_eas(model_name, savedir_sample):
                     )
 
             def upload_generation_method(generation_method):
-                if generation_method == "Video Generation":
-                    return gr.update(visible=True, minimum=5, maximum=49, value=49, interactive=True)
-                elif generation_method == "Image Generation":
-                    return gr.update(minimum=1, maximum=1, value=1, interactive=False)
+                return dict(eas_generation_method_updates[generation_method])
             generation_method.change(
                 upload_generation_method, generation_method, [length_slider]
             )
 
             def upload_source_method(source_method):
-                if source_method == "Text to Video (文本到视频)":
-                    return [gr.update(visible=False), gr.update(visible=False), gr.update(value=None), gr.update(value=None), gr.update(value=None)]
-                elif source_method == "Image to Video (图片到视频)":
-                    return [gr.update(visible=True), gr.update(visible=False), gr.update(), gr.update(), gr.update(value=None)]
-                else:
-                    return [gr.update(visible=False), gr.update(visible=True), gr.update(value=None), gr.update(value=None), gr.update()]
+                return copy_updates(eas_source_method_updates[source_method])
             source_method.change(
                 upload_source_method, source_method, [image_to_video_col, video_to_video_col, start_image, end_image, validation_video]
             )
 
             def upload_resize_method(resize_method):
-                if resize_method == "Generate by":
-                    return [gr.update(visible=True), gr.update(visible=True), gr.update(visible=False)]
-                else:
-                    return [gr.update(visible=False), gr.update(visible=False), gr.update(visible=True)]
+                return copy_updates(eas_resize_method_updates[resize_method])
             resize_method.change(
                 upload_resize_method, resize_method, [width_slider, height_slider, base_resolution]
             )
 
             generate_button.click(
-                fn=controller.generate,
+                fn=lambda *inputs: get_controller().generate(*inputs),
                 inputs=[
                     diffusion_transformer_dropdown,
                     base_model_dropdown,
@@ -1400,4 +1663,5 @@ def ui_eas(model_name, savedir_sample):
                 ],
                 outputs=[result_image, result_video, infer_progress]
             )
-    return demo, controller
\ No newline at end of file
+    # Generation is forwarded to the EAS service, there is no local controller to serve the apis
+    return demo, None
\ No newline at end of file
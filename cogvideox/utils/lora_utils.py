@@ -406,14 +406,19 @@ def merge_lora(pipeline, lora_path, multiplier, device='cpu', dtype=torch.float3
                 else:
                     temp_name = layer_infos.pop(0)
 
-        weight_up = elems['lora_up.weight'].to(dtype)
-        weight_down = elems['lora_down.weight'].to(dtype)
+        # Merge on the device that already holds the layer, so that no weight is moved away from
+        # the rest of its module and offload hooks keep seeing their own tensors.
+        weight_device = curr_layer.weight.device
+        if weight_device.type == "meta":
+            # Sequential cpu offload keeps the real weights in the offload hook, the merge would be lost
+            raise RuntimeError("Lora can not be merged into weights offloaded with sequential cpu offload.")
+        weight_up = elems['lora_up.weight'].to(device=weight_device, dtype=dtype, non_blocking=True)
+        weight_down = elems['lora_down.weight'].to(device=weight_device, dtype=dtype, non_blocking=True)
         if 'alpha' in elems.keys():
             alpha = elems['alpha'].item() / weight_up.shape[1]
         else:
             alpha = 1.0
 
-        curr_layer.weight.data = curr_layer.weight.data.to(device)
         if len(weight_up.shape) == 4:
             curr_layer.weight.data += multiplier * alpha * torch.mm(weight_up.squeeze(3).squeeze(2),
                                                                     weight_down.squeeze(3).squeeze(2)).unsqueeze(
@@ -424,11 +429,12 @@ def merge_lora(pipeline, lora_path, multiplier, device='cpu', dtype=torch.float3
     return pipeline
 
 # TODO: Refactor with merge_lora.
-def unmerge_lora(pipeline, lora_path, multiplier=1, device="cpu", dtype=torch.float32):
+def unmerge_lora(pipeline, lora_path, multiplier=1, device="cpu", dtype=torch.float32, state_dict=None):
     """Unmerge state_dict in LoRANetwork from the pipeline in diffusers."""
     LORA_PREFIX_UNET = "lora_unet"
     LORA_PREFIX_TEXT_ENCODER = "lora_te"
-    state_dict = load_file(lora_path, device=device)
+    if state_dict is None:
+        state_dict = load_file(lora_path, device=device)
 
     updates = defaultdict(dict)
     for key, value in state_dict.items():
@@ -460,14 +466,19 @@ def unmerge_lora(pipeline, lora_path, multiplier=1, device="cpu", dtype=torch.fl
                 else:
                     temp_name = layer_infos.pop(0)
 
-        weight_up = elems['lora_up.weight'].to(dtype)
-        weight_down = elems['lora_down.weight'].to(dtype)
+        # Merge on the device that already holds the layer, so that no weight is moved away from
+        # the rest of its module and offload hooks keep seeing their own tensors.
+        weight_device = curr_layer.weight.device
+        if weight_device.type == "meta":
+            # Sequential cpu offload keeps the real weights in the offload hook, the merge would be lost
+            raise RuntimeError("Lora can not be merged into weights offloaded with sequential cpu offload.")
+        weight_up = elems['lora_up.weight'].to(device=weight_device, dtype=dtype, non_blocking=True)
+        weight_down = elems['lora_down.weight'].to(device=weight_device, dtype=dtype, non_blocking=True)
         if 'alpha' in elems.keys():
             alpha = elems['alpha'].item() / weight_up.shape[1]
         else:
             alpha = 1.0
 
-        curr_layer.weight.data = curr_layer.weight.data.to(device)
         if len(weight_up.shape) == 4:
             curr_layer.weight.data -= multiplier * alpha * torch.mm(weight_up.squeeze(3).squeeze(2),
                                                                     weight_down.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
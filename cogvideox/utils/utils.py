@@ -3,6 +3,7 @@ import gc
 import imageio
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision
 import cv2
 from einops import rearrange
@@ -45,14 +46,18 @@ def color_transfer(sc, dc):
     return dst
 
 def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, fps=12, imageio_backend=True, color_transfer_post_process=False):
+    # videos are floats in [0, 1] ([-1, 1] with rescale), or already converted uint8 in [0, 255]
     videos = rearrange(videos, "b c t h w -> t b c h w")
     outputs = []
     for x in videos:
         x = torchvision.utils.make_grid(x, nrow=n_rows)
         x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        x = (x * 255).numpy().astype(np.uint8)
+        if x.dtype == torch.uint8:
+            x = x.numpy()
+        else:
+            if rescale:
+                x = (x + 1.0) / 2.0  # -1,1 -> 0,1
+            x = (x * 255).numpy().astype(np.uint8)
         outputs.append(Image.fromarray(x))
 
     if color_transfer_post_process:
@@ -70,12 +75,22 @@ def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, f
             path = path.replace('.mp4', '.gif')
         outputs[0].save(path, format='GIF', append_images=outputs, save_all=True, duration=100, loop=0)
 
+def resize_frames(frames, sample_size):
+    # frames: torch.Tensor of shape (N, C, H, W) with values in [0, 1]
+    if tuple(frames.shape[-2:]) != tuple(sample_size):
+        frames = F.interpolate(frames, size=tuple(sample_size), mode="bicubic", align_corners=False).clamp(0, 1)
+    return frames
+
 def get_image_to_video_latent(validation_image_start, validation_image_end, video_length, sample_size):
+    # validation_image_start can be a path, a list of PIL images, or a torch.Tensor of
+    # shape (N, C, H, W) in [0, 1], e.g. the last frames of a previously generated clip.
     if validation_image_start is not None and validation_image_end is not None:
         if type(validation_image_start) is str and os.path.isfile(validation_image_start):
             image_start = clip_image = Image.open(validation_image_start).convert("RGB")
             image_start = image_start.resize([sample_size[1], sample_size[0]])
             clip_image = clip_image.resize([sample_size[1], sample_size[0]])
+        elif torch.is_tensor(validation_image_start):
+            image_start = clip_image = resize_frames(validation_image_start, sample_size)
         else:
             image_start = clip_image = validation_image_start
             image_start = [_image_start.resize([sample_size[1], sample_size[0]]) for _image_start in image_start]
@@ -88,12 +103,15 @@ def get_image_to_video_latent(validation_image_start, validation_image_end, vide
             image_end = validation_image_end
             image_end = [_image_end.resize([sample_size[1], sample_size[0]]) for _image_end in image_end]
 
-        if type(image_start) is list:
+        if type(image_start) is list or torch.is_tensor(image_start):
             clip_image = clip_image[0]
-            start_video = torch.cat(
-                [torch.from_numpy(np.array(_image_start)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0) for _image_start in image_start], 
-                dim=2
-            )
+            if torch.is_tensor(image_start):
+                start_video = image_start.permute(1, 0, 2, 3).unsqueeze(0) * 255
+            else:
+                start_video = torch.cat(
+                    [torch.from_numpy(np.array(_image_start)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0) for _image_start in image_start], 
+                    dim=2
+                )
             input_video = torch.tile(start_video[:, :, :1], [1, 1, video_length, 1, 1])
             input_video[:, :, :len(image_start)] = start_video
             
@@ -107,8 +125,13 @@ def get_image_to_video_latent(validation_image_start, validation_image_end, vide
             input_video_mask = torch.zeros_like(input_video[:, :1])
             input_video_mask[:, :, 1:] = 255
 
+        if torch.is_tensor(image_start):
+            image_start_size = (image_start.shape[-1], image_start.shape[-2])
+        else:
+            image_start_size = image_start[0].size if type(image_start) is list else image_start.size
+
         if type(image_end) is list:
-            image_end = [_image_end.resize(image_start[0].size if type(image_start) is list else image_start.size) for _image_end in image_end]
+            image_end = [_image_end.resize(image_start_size) for _image_end in image_end]
             end_video = torch.cat(
                 [torch.from_numpy(np.array(_image_end)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0) for _image_end in image_end], 
                 dim=2
@@ -117,7 +140,7 @@ def get_image_to_video_latent(validation_image_start, validation_image_end, vide
             
             input_video_mask[:, :, -len(image_end):] = 0
         else:
-            image_end = image_end.resize(image_start[0].size if type(image_start) is list else image_start.size)
+            image_end = image_end.resize(image_start_size)
             input_video[:, :, -1:] = torch.from_numpy(np.array(image_end)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0)
             input_video_mask[:, :, -1:] = 0
 
@@ -128,18 +151,23 @@ def get_image_to_video_latent(validation_image_start, validation_image_end, vide
             image_start = clip_image = Image.open(validation_image_start).convert("RGB")
             image_start = image_start.resize([sample_size[1], sample_size[0]])
             clip_image = clip_image.resize([sample_size[1], sample_size[0]])
+        elif torch.is_tensor(validation_image_start):
+            image_start = clip_image = resize_frames(validation_image_start, sample_size)
         else:
             image_start = clip_image = validation_image_start
             image_start = [_image_start.resize([sample_size[1], sample_size[0]]) for _image_start in image_start]
             clip_image = [_clip_image.resize([sample_size[1], sample_size[0]]) for _clip_image in clip_image]
         image_end = None
         
-        if type(image_start) is list:
+        if type(image_start) is list or torch.is_tensor(image_start):
             clip_image = clip_image[0]
-            start_video = torch.cat(
-                [torch.from_numpy(np.array(_image_start)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0) for _image_start in image_start], 
-                dim=2
-            )
+            if torch.is_tensor(image_start):
+                start_video = image_start.permute(1, 0, 2, 3).unsqueeze(0) * 255
+            else:
+                start_video = torch.cat(
+                    [torch.from_numpy(np.array(_image_start)).permute(2, 0, 1).unsqueeze(1).unsqueeze(0) for _image_start in image_start], 
+                    dim=2
+                )
             input_video = torch.tile(start_video[:, :, :1], [1, 1, video_length, 1, 1])
             input_video[:, :, :len(image_start)] = start_video
             input_video = input_video / 255